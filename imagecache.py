@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+"""
+decompressed image cache for the USB mass storage gadget
+
+Images can be stored zstd, xz or gzip compressed to save space on the
+SD card. Before export they are decompressed into CACHE_DIR (on disk or
+tmpfs) and the decompressed copy is what the gadget serves.
+
+Decompression streams from the external tool where it is installed
+(zstd, xz, pigz/gzip) and falls back to the python modules. Worker
+threads write the output and skip blocks of zeros so the cache file
+stays sparse.
+
+Cache files are named after the sha256 of the compressed image so an
+unchanged image is only decompressed once. The digest itself is
+remembered against the image's size, mtime and inode so it isn't
+recalculated on every boot. When the cache grows past its size limit
+the least recently used files are removed. Anything else found in
+CACHE_DIR (e.g. a .part file left by a power cut during decompression)
+is deleted, so CACHE_DIR must not be used for anything else.
+
+Used by set_id.py -s. Can also be run on its own:
+    imagecache.py <image>
+prints the path to export.
+"""
+
+## Imports
+import argparse
+import errno
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import lzma
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+## Globals
+CACHE_DIR = '/var/cache/usb-gadget'
+CACHE_SIZE = 4096 # MiB
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+# integrity manifest imagecheck.py keeps next to a cached copy
+MANIFEST_SUFFIX = '.chunks'
+THREADS = os.cpu_count() or 1
+# read/hash size
+CHUNK_SIZE = 1024 * 1024
+# smallest run of zeros left as a hole
+SPARSE_BLOCK = 64 * 1024
+ZERO_CHUNK = b'\x00' * CHUNK_SIZE
+# what the python decompressors raise on truncated or corrupt input
+DECOMPRESS_ERRORS = ((EOFError, lzma.LZMAError, zlib.error)
+                     + ((gzip.BadGzipFile,) if hasattr(gzip, 'BadGzipFile') else ())
+                     + ((zstandard.ZstdError,) if zstandard else ()))
+# format: (magic, commands to try in order, python fallback)
+FORMATS = {'zstd': (b'\x28\xb5\x2f\xfd',
+                    [['zstd', '-d', '-c', '-q']],
+                    (lambda p: zstandard.open(p, 'rb')) if zstandard else None),
+           'xz': (b'\xfd7zXZ\x00',
+                  [['xz', '-d', '-c', '-T0'], ['xz', '-d', '-c']],
+                  lambda p: lzma.open(p, 'rb')),
+           'gzip': (b'\x1f\x8b',
+                    [['pigz', '-d', '-c'], ['gzip', '-d', '-c']],
+                    lambda p: gzip.open(p, 'rb'))}
+
+
+## Functions - helpers
+def compression(path):
+    """Compression format of path by its magic number, or None"""
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    for name, (magic, commands, fallback) in FORMATS.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def allocated(path):
+    """Bytes actually used on disk by path"""
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+def loadIndex(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        index = {}
+    index.setdefault('entries', {})
+    index.setdefault('digests', {})
+    return index
+
+def saveIndex(cache_dir, index):
+    target = os.path.join(cache_dir, INDEX_FILE)
+    with open(target + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.rename(target + '.tmp', target)
+
+def imageDigest(path, index):
+    """sha256 of path, reused from index if the file hasn't changed"""
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+    known = index['digests'].get(key)
+    if known and known['stamp'] == stamp:
+        return known['digest']
+    logging.debug('\tHashing %s' % path)
+    digest = sha256(path)
+    index['digests'][key] = {'stamp': stamp, 'digest': digest}
+    return digest
+
+
+## Functions - decompression
+def openStream(path, fmt):
+    """
+    Decompressed stream of path
+    returns (file object, process or None)
+    """
+
+    magic, commands, fallback = FORMATS[fmt]
+    for cmd in commands:
+        try:
+            proc = subprocess.Popen(cmd + [path], stdout=subprocess.PIPE,
+                                    bufsize=CHUNK_SIZE)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        logging.debug('\tDecompressing with %s' % ' '.join(cmd))
+        return proc.stdout, proc
+    if fallback is None:
+        raise RuntimeError('No %s decompressor available for %s' % (fmt, path))
+    logging.debug('\tDecompressing with python %s module' % fmt)
+    return fallback(path), None
+
+def expectedSize(path, fmt):
+    """
+    Decompressed size of path where the format records it, else 0
+    gzip only keeps it modulo 4GiB so it's a hint, not a promise
+    """
+
+    try:
+        if fmt == 'gzip':
+            with open(path, 'rb') as f:
+                f.seek(-4, os.SEEK_END)
+                return struct.unpack('<I', f.read(4))[0]
+        if fmt == 'xz':
+            # reads the index at the end of the file, not the data
+            out = subprocess.check_output(['xz', '--robot', '--list', path],
+                                          stderr=subprocess.STDOUT)
+            for line in out.decode('ascii', 'replace').splitlines():
+                fields = line.split('\t')
+                if fields[0] == 'totals':
+                    return int(fields[4])
+        if fmt == 'zstd' and zstandard:
+            with open(path, 'rb') as f:
+                size = zstandard.frame_content_size(f.read(18))
+            return max(size, 0)
+    except (IOError, OSError, ValueError, IndexError, subprocess.CalledProcessError):
+        pass
+    except DECOMPRESS_ERRORS:
+        pass
+    return 0
+
+def writeSparse(fd, data, offset):
+    """pwrite data at offset leaving holes for SPARSE_BLOCK runs of zeros"""
+    if data == ZERO_CHUNK[:len(data)]:
+        return
+    start = None
+    for pos in range(0, len(data), SPARSE_BLOCK):
+        block = data[pos:pos + SPARSE_BLOCK]
+        if block == ZERO_CHUNK[:len(block)]:
+            if start is not None:
+                os.pwrite(fd, data[start:pos], offset + start)
+                start = None
+        elif start is None:
+            start = pos
+    if start is not None:
+        os.pwrite(fd, data[start:], offset + start)
+
+def readFull(stream, size):
+    """read exactly size bytes unless at end of stream (pipes return short reads)"""
+    parts = []
+    while size:
+        data = stream.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+def decompress(src, dest, fmt, threads=THREADS):
+    """
+    Decompress src to a sparse dest
+    returns the decompressed size
+    """
+
+    work = queue.Queue(maxsize=threads * 4)
+    errors = []
+
+    def writer():
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            if errors:
+                # drain so the reader never blocks
+                continue
+            try:
+                writeSparse(fd, item[1], item[0])
+            except OSError as e:
+                errors.append(e)
+
+    stream, proc = openStream(src, fmt)
+    partial = dest + '.part'
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    workers = [threading.Thread(target=writer) for i in range(threads)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    offset = 0
+    complete = False
+    try:
+        while not errors:
+            try:
+                data = readFull(stream, CHUNK_SIZE)
+            except DECOMPRESS_ERRORS as e:
+                raise RuntimeError('%s is damaged (%s)' % (src, e))
+            if not data:
+                complete = True
+                break
+            work.put((offset, data))
+            offset += len(data)
+    finally:
+        for w in workers:
+            work.put(None)
+        for w in workers:
+            w.join()
+        stream.close()
+        if proc is not None and proc.wait() != 0 and not errors:
+            errors.append(RuntimeError('%s exited with %d' % (proc.args[0], proc.returncode)))
+        if complete and not errors:
+            # trailing zeros were skipped, set the real size
+            os.ftruncate(fd, offset)
+        os.close(fd)
+        if errors or not complete:
+            os.unlink(partial)
+    if errors:
+        raise errors[0]
+    os.rename(partial, dest)
+    return offset
+
+
+## Functions - cache
+def discard(path):
+    """
+    Remove a cached copy, e.g. one that failed verification
+    cachedImage() decompresses it again next time
+    """
+
+    for target in (path, path + MANIFEST_SUFFIX):
+        try:
+            os.unlink(target)
+        except OSError:
+            pass
+
+def tidy(cache_dir, index):
+    """
+    Delete files the index doesn't know about, e.g. .part files left by
+    a decompression that was interrupted, and forget entries whose file
+    is gone. Must be called with the lock held.
+    """
+
+    keep = set([INDEX_FILE, LOCK_FILE])
+    for digest in list(index['entries']):
+        if os.path.isfile(os.path.join(cache_dir, digest)):
+            keep.update([digest, digest + MANIFEST_SUFFIX])
+        else:
+            del index['entries'][digest]
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name in keep or not os.path.isfile(path):
+            continue
+        logging.debug('\tRemoving stray %s' % path)
+        try:
+            os.unlink(path)
+        except OSError as e:
+            logging.warning('\tCould not remove %s (%s)' % (path, e))
+
+def evict(cache_dir, index, limit, keep=None):
+    """Remove least recently used entries until the cache fits in limit bytes"""
+    entries = index['entries']
+    usage = sum(allocated(os.path.join(cache_dir, d)) for d in entries)
+    for digest in sorted(entries, key=lambda d: entries[d]['last_used']):
+        if usage <= limit:
+            break
+        if digest == keep:
+            continue
+        path = os.path.join(cache_dir, digest)
+        size = allocated(path)
+        logging.debug('\tEvicting %s (%s)' % (digest, entries[digest]['source']))
+        discard(path)
+        del entries[digest]
+        usage -= size
+    if usage > limit:
+        logging.warning('\tImage cache uses %d MiB, over its %d MiB limit'
+                        % (usage // 2**20, limit // 2**20))
+
+def cachedImage(path, cache_dir=CACHE_DIR, cache_size=CACHE_SIZE, threads=THREADS):
+    """
+    Path to export for image path
+    decompresses path into the cache if needed
+    cache_size is in MiB
+    """
+
+    fmt = compression(path)
+    if fmt is None:
+        return path
+    logging.info('Image %s is %s compressed' % (path, fmt))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(os.path.join(cache_dir, LOCK_FILE), 'w') as lock:
+        # another instance may be using the cache
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = loadIndex(cache_dir)
+        tidy(cache_dir, index)
+        # forget digests of images that no longer exist
+        for known in [k for k in index['digests'] if not os.path.exists(k)]:
+            del index['digests'][known]
+        digest = imageDigest(path, index)
+        target = os.path.join(cache_dir, digest)
+        if digest in index['entries']:
+            logging.debug('\tUsing cached %s' % target)
+        else:
+            logging.debug('\tDecompressing to %s' % target)
+            # make room first, a cache on tmpfs can't grow past its limit
+            expected = expectedSize(path, fmt)
+            logging.debug('\tExpecting %d MiB' % (expected // 2**20))
+            evict(cache_dir, index, max(0, cache_size * 2**20 - expected))
+            start = time.time()
+            try:
+                size = decompress(path, target, fmt, threads)
+            except OSError as e:
+                if e.errno != errno.ENOSPC or not index['entries']:
+                    raise
+                # the estimate was missing or too small, make all the room there is
+                logging.warning('\tOut of space, emptying the cache and retrying')
+                evict(cache_dir, index, 0)
+                saveIndex(cache_dir, index)
+                size = decompress(path, target, fmt, threads)
+            elapsed = time.time() - start
+            logging.info('\tDecompressed %d MiB in %.1fs (%d MiB on disk)'
+                         % (size // 2**20, elapsed, allocated(target) // 2**20))
+            index['entries'][digest] = {'source': os.path.abspath(path), 'size': size}
+        index['entries'][digest]['last_used'] = time.time()
+        evict(cache_dir, index, cache_size * 2**20, keep=digest)
+        saveIndex(cache_dir, index)
+    return target
+
+
+## Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decompress an image into the cache and print the path to export.')
+    parser.add_argument('image',
+                        help='image, optionally zstd, xz or gzip compressed')
+    parser.add_argument('-C', '--cache-dir',
+                        action='store',
+                        dest='cache_dir',
+                        default=CACHE_DIR,
+                        help="decompressed image cache, used for nothing else. Defaults to '%(default)s'")
+    parser.add_argument('-S', '--cache-size',
+                        action='store',
+                        dest='cache_size',
+                        type=int,
+                        default=CACHE_SIZE,
+                        help='cache size limit in MiB. Defaults to %(default)s')
+    parser.add_argument('-j', '--threads',
+                        action='store',
+                        type=int,
+                        default=THREADS,
+                        help='writer threads. Defaults to %(default)s')
+    parser.add_argument('-d', '--debug',
+                        action='store_const',
+                        dest='debug',
+                        const=logging.DEBUG,
+                        default=logging.WARNING,
+                        help='Enable debug output')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s\t: %(message)s', level=args.debug)
+    try:
+        print(cachedImage(args.image, args.cache_dir, args.cache_size, args.threads))
+    except (IOError, OSError, RuntimeError) as e:
+        sys.exit('Failed: %s' % e)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+integrity checks for USB mass storage images
+
+Images are hashed in CHUNK_SIZE chunks, in parallel, each chunk read
+with os.pread. Not mmap: a 32 bit Pi can't map a multi-GB image and a
+read error inside a mapping kills the process with SIGBUS instead of
+raising an error. A chunk that can't be read counts as corrupt. The
+sha256 of every chunk is kept in a manifest next to the image
+(<image>.chunks). Later checks compare against it:
+
+    no manifest             hash everything, write the manifest
+    size or mtime changed   the image was modified on purpose (e.g. by
+                            the USB host), hash everything, report which
+                            chunks changed and update the manifest
+    unchanged               re-hash a rotating sample of chunks, a
+                            different one each time, so the whole image
+                            is covered every few boots without paying
+                            for it on any one of them
+
+A sampled chunk that no longer matches means the image is corrupt.
+The manifest is then left alone so later checks still see it.
+
+Used by set_id.py -V. Can also be run on its own:
+    imagecheck.py <image>
+"""
+
+## Imports
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+## Globals
+CHUNK_SIZE = 4 * 1024 * 1024
+MANIFEST_SUFFIX = '.chunks'
+MANIFEST_VERSION = 1
+# chunks re-hashed per check when the image is unchanged
+SAMPLE_FRACTION = 1.0 / 16
+SAMPLE_MIN = 4
+THREADS = os.cpu_count() or 1
+# results
+OK = 'ok'
+NEW = 'new'
+CHANGED = 'changed'
+CORRUPT = 'corrupt'
+
+
+## Functions - hashing
+def hashChunks(path, indexes, chunk_size=CHUNK_SIZE, threads=THREADS):
+    """
+    sha256 of the chunks of path listed in indexes
+    returns a dict of index: hex digest, None for unreadable chunks
+    """
+
+    if not indexes:
+        return {}
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # pread and hashlib both drop the GIL so threads really run in parallel
+        def one(i):
+            try:
+                data = os.pread(fd, chunk_size, i * chunk_size)
+            except OSError as e:
+                logging.error('\t%s: chunk %d (offset %d) can not be read (%s)'
+                              % (path, i, i * chunk_size, e))
+                return i, None
+            return i, hashlib.sha256(data).hexdigest()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            return dict(pool.map(one, indexes))
+    finally:
+        os.close(fd)
+
+def chunkCount(size, chunk_size=CHUNK_SIZE):
+    return (size + chunk_size - 1) // chunk_size
+
+
+## Functions - manifest
+def manifestPath(path):
+    return path + MANIFEST_SUFFIX
+
+def loadManifest(path):
+    try:
+        with open(manifestPath(path), 'r') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def saveManifest(path, manifest):
+    target = manifestPath(path)
+    try:
+        with open(target + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.rename(target + '.tmp', target)
+    except (IOError, OSError) as e:
+        logging.warning('\tCould not write %s (%s)' % (target, e))
+        return False
+    return True
+
+
+## Functions - checking
+def sample(manifest, count):
+    """Next count chunk indexes in rotation"""
+    total = len(manifest['chunks'])
+    if total == 0:
+        return []
+    start = manifest.get('next', 0) % total
+    return [(start + i) % total for i in range(min(count, total))]
+
+def check(path, full=False, update=True, chunk_size=CHUNK_SIZE,
+          fraction=SAMPLE_FRACTION, threads=THREADS):
+    """
+    Check path against its manifest
+    returns (result, list of bad or changed chunk indexes)
+    update=False leaves the manifest untouched
+    """
+
+    start = time.time()
+    st = os.stat(path)
+    total = chunkCount(st.st_size, chunk_size)
+    manifest = loadManifest(path)
+    if manifest is not None and manifest['chunk_size'] != chunk_size:
+        manifest = None
+    stamp = [st.st_size, st.st_mtime_ns]
+
+    if manifest is None or manifest['stamp'] != stamp:
+        digests = hashChunks(path, range(total), chunk_size, threads)
+        chunks = [digests[i] for i in range(total)]
+        unreadable = [i for i in range(total) if chunks[i] is None]
+        if unreadable:
+            result, bad = CORRUPT, unreadable
+        elif manifest is None:
+            result, bad = NEW, []
+        else:
+            old = manifest['chunks']
+            result = CHANGED
+            bad = [i for i in range(total) if i >= len(old) or old[i] != chunks[i]]
+        manifest = {'version': MANIFEST_VERSION,
+                    'chunk_size': chunk_size,
+                    'stamp': stamp,
+                    'chunks': chunks,
+                    'next': 0}
+        checked = total
+    else:
+        if full:
+            indexes = list(range(total))
+        else:
+            indexes = sample(manifest, max(SAMPLE_MIN, int(total * fraction)))
+        digests = hashChunks(path, indexes, chunk_size, threads)
+        bad = sorted(i for i in indexes if digests[i] != manifest['chunks'][i])
+        result = CORRUPT if bad else OK
+        if indexes and not full:
+            manifest['next'] = (indexes[-1] + 1) % total
+        checked = len(indexes)
+
+    elapsed = time.time() - start
+    logging.info('\t%s: %s, %d of %d chunks hashed in %.2fs'
+                 % (path, result, checked, total, elapsed))
+    if result == CORRUPT:
+        for i in bad:
+            logging.error('\t%s: chunk %d (offset %d) does not match its digest'
+                          % (path, i, i * chunk_size))
+    elif result == CHANGED:
+        logging.info('\t%s: %d chunks changed since the last check' % (path, len(bad)))
+    # never replace good digests with those of a corrupt image
+    if update and result != CORRUPT:
+        saveManifest(path, manifest)
+    return result, bad
+
+
+## Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check an image against its chunk digest manifest, creating it if needed.')
+    parser.add_argument('image',
+                        help='image to check')
+    parser.add_argument('-a', '--all',
+                        action='store_true',
+                        help='hash every chunk, not just a sample')
+    parser.add_argument('-n', '--dry-run',
+                        action='store_true',
+                        dest='dry_run',
+                        help="don't write the manifest")
+    parser.add_argument('-j', '--threads',
+                        action='store',
+                        type=int,
+                        default=THREADS,
+                        help='hashing threads. Defaults to %(default)s')
+    parser.add_argument('-d', '--debug',
+                        action='store_const',
+                        dest='debug',
+                        const=logging.DEBUG,
+                        default=logging.INFO,
+                        help='Enable debug output')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s\t: %(message)s', level=args.debug)
+    try:
+        result, bad = check(args.image, full=args.all, update=not args.dry_run,
+                            threads=args.threads)
+    except (IOError, OSError) as e:
+        sys.exit('Failed: %s' % e)
+    if result == CORRUPT:
+        sys.exit(1)
@@ -0,0 +1,164 @@
+#!/bin/bash
+
+# benchmark USB ethernet gadget functions against each other
+#
+# uses dummy_hcd so both ends of the USB link are on this machine.
+# the gadget end is moved into its own network namespace so traffic
+# really crosses the (virtual) USB link rather than the loopback.
+#
+# usage:
+#	netbench.bash [-t seconds] [-q qmult] [function ...]
+#
+# functions default to "ecm ncm eem rndis"
+#
+# must be run as root
+# iperf3 must be installed (sudo apt install iperf3)
+# the kernel must provide dummy_hcd, libcomposite and the host side
+# drivers (cdc_ether, cdc_ncm, cdc_eem, rndis_host)
+# do not run while a real gadget is configured
+
+GADGET=/sys/kernel/config/usb_gadget/netbench
+NETNS=netbench
+HOST_MAC=02:00:00:00:be:01
+DEV_MAC=06:00:00:00:be:01
+HOST_IP=10.99.0.2
+DEV_IP=10.99.0.1
+DURATION=10
+QMULT=
+
+usage() {
+	echo "usage: $0 [-t seconds] [-q qmult] [function ...]" > /dev/stderr
+	exit 1
+}
+
+while getopts "t:q:h" opt; do
+	case $opt in
+		t) DURATION=$OPTARG ;;
+		q) QMULT=$OPTARG ;;
+		*) usage ;;
+	esac
+done
+shift $((OPTIND - 1))
+FUNCTIONS=${@:-ecm ncm eem rndis}
+
+if [ `id -u` != 0 ]; then
+	echo "Must be root" > /dev/stderr
+	exit 1
+fi
+
+which iperf3 >/dev/null 2>&1
+if [ $? != 0 ]; then
+	echo "iperf3 not found" > /dev/stderr
+	exit 1
+fi
+
+/sbin/modprobe dummy_hcd && /sbin/modprobe libcomposite
+if [ $? != 0 ]; then
+	echo "Failed to load dummy_hcd or libcomposite." > /dev/stderr
+	exit 1
+fi
+
+UDC=`ls /sys/class/udc | grep dummy_udc | head -n 1`
+if [ -z "$UDC" ]; then
+	echo "No dummy UDC found." > /dev/stderr
+	exit 1
+fi
+
+gadget_up() {
+	# $1 function name
+	mkdir -p $GADGET/strings/0x409 $GADGET/configs/c.1/strings/0x409 || return 1
+	mkdir $GADGET/functions/$1.usb0 || return 1
+	echo 0x1d6b > $GADGET/idVendor
+	echo 0x0104 > $GADGET/idProduct
+	echo netbench > $GADGET/strings/0x409/product
+	echo "Config 1: $1 network" > $GADGET/configs/c.1/strings/0x409/configuration
+	echo $HOST_MAC > $GADGET/functions/$1.usb0/host_addr
+	echo $DEV_MAC > $GADGET/functions/$1.usb0/dev_addr
+	if [ -n "$QMULT" ]; then
+		echo $QMULT > $GADGET/functions/$1.usb0/qmult
+	fi
+	ln -s $GADGET/functions/$1.usb0 $GADGET/configs/c.1/
+	echo $UDC > $GADGET/UDC
+}
+
+gadget_down() {
+	# $1 function name
+	[ -d $GADGET ] || return 0
+	echo "" > $GADGET/UDC 2>/dev/null
+	rm -f $GADGET/configs/c.1/$1.usb0
+	rmdir $GADGET/configs/c.1/strings/0x409 $GADGET/configs/c.1 \
+		$GADGET/functions/$1.usb0 $GADGET/strings/0x409 $GADGET 2>/dev/null
+}
+
+host_iface() {
+	# find the host side interface by the USB bus it sits on.
+	# not by MAC address: cdc_eem ignores host_addr and makes one up
+	for i in /sys/class/net/*; do
+		case "`readlink -f $i/device 2>/dev/null`" in
+			*/dummy_hcd*)
+				basename $i
+				return 0
+				;;
+		esac
+	done
+	return 1
+}
+
+throughput() {
+	# $@ extra iperf3 client args
+	# prints receiver bitrate in Mbits/sec
+	iperf3 -c $DEV_IP -t $DURATION -f m "$@" 2>/dev/null | awk '/receiver/ {print $(NF-2)}'
+}
+
+bench() {
+	# $1 function name
+	local gif hif n fwd rev srv
+
+	gadget_up $1
+	if [ $? != 0 ]; then
+		echo "$1: failed to create gadget (is usb_f_$1 available?)" > /dev/stderr
+		gadget_down $1
+		return 1
+	fi
+	gif=`cat $GADGET/functions/$1.usb0/ifname`
+
+	# wait for the host to enumerate the gadget
+	for n in `seq 20`; do
+		hif=`host_iface` && break
+		sleep 0.5
+	done
+	if [ -z "$hif" ]; then
+		echo "$1: host side interface did not appear" > /dev/stderr
+		gadget_down $1
+		return 1
+	fi
+
+	ip netns add $NETNS
+	ip link set $gif netns $NETNS
+	ip netns exec $NETNS ip addr add $DEV_IP/24 dev $gif
+	ip netns exec $NETNS ip link set $gif up
+	ip addr add $HOST_IP/24 dev $hif
+	ip link set $hif up
+
+	ip netns exec $NETNS iperf3 -s >/dev/null 2>&1 &
+	srv=$!
+	sleep 1
+	fwd=`throughput`
+	rev=`throughput -R`
+	kill $srv 2>/dev/null
+	wait $srv 2>/dev/null
+
+	# deleting the namespace returns the gadget interface to the host
+	ip netns del $NETNS
+	gadget_down $1
+
+	printf "%-8s %12s %12s\n" $1 ${fwd:-failed} ${rev:-failed}
+}
+
+trap 'ip netns del $NETNS 2>/dev/null; for f in $FUNCTIONS; do gadget_down $f; done' EXIT
+
+printf "%-8s %12s %12s\n" function "host->dev" "dev->host"
+printf "%-8s %12s %12s\n" "" "Mbits/sec" "Mbits/sec"
+for f in $FUNCTIONS; do
+	bench $f
+done
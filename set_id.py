@@ -38,6 +38,21 @@ USB_DEV_NAME = 'foo'
 HOSTNAME_PREFIX = 'PI-'
 MAC_PREFIX_HOST = '02'
 MAC_PREFIX_DEVICE = '06'
+# network function and the legacy module (plus extra parameters) that provides it
+USB_NET_FUNCTION = 'ecm'
+USB_NET_MODULES = {'ecm': ('g_ether', []),
+                   'ncm': ('g_ncm', []),
+                   'eem': ('g_ether', ['use_eem=1']),
+                   'rndis': ('g_ether', [])}
+USB_NET_IFACE = 'usb0'
+# qmult is a u8 in configfs and 0 would leave no queue at all
+USB_QMULT_RANGE = (1, 255)
+# DHCP server for the USB host
+DHCP_SERVER = os.path.join(sys.path[0], 'usb_dhcpd.py')
+DHCP_LOG = '/var/log/usb_dhcpd.log' # used when there is no -l
+# decompressed image cache, see imagecache.py
+IMAGE_CACHE_DIR = '/var/cache/usb-gadget'
+IMAGE_CACHE_SIZE = 4096 # MiB
 # hostname
 MAX_HOSTNAME_LENGTH = 15 # windows limit, the actual RFC one is higher
 HOSTNAME_LOOKUP_FILE = '/boot/hostnames'
@@ -57,7 +72,9 @@ def USBComposite(name=USB_DEV_NAME,
               host_mac='02:27:eb:b3:96:23',
               dev_mac='06:27:eb:b3:96:23',
               storage='',
-              devserial='1234567890'):
+              devserial='1234567890',
+              function=USB_NET_FUNCTION,
+              qmult=None):
 
     logging.debug('\tLoading libcomposite')
     try:
@@ -71,7 +88,8 @@ def USBComposite(name=USB_DEV_NAME,
         device_base = os.path.join(USB_BASE_DIR, USB_DEV_NAME)
         strings_dir = os.path.join(device_base, 'strings/0x409')
         functions_dir = os.path.join(device_base, 'functions')
-        ecm_dir = os.path.join(functions_dir, 'ecm.usb0')
+        net_name = '%s.usb0' % function
+        net_dir = os.path.join(functions_dir, net_name)
         mass_dir = os.path.join(functions_dir, 'mass_storage.usb0')
         lun_dir = os.path.join(mass_dir, 'lun.0')
         configs_dir = os.path.join(device_base, 'configs/c.1')
@@ -83,8 +101,8 @@ def USBComposite(name=USB_DEV_NAME,
         os.makedirs(device_base)
         logging.debug('\t\t\t%s' % strings_dir)
         os.makedirs(strings_dir)
-        logging.debug('\t\t\t%s' % ecm_dir)
-        os.makedirs(ecm_dir)
+        logging.debug('\t\t\t%s' % net_dir)
+        os.makedirs(net_dir)
         logging.debug('\t\t\t%s' % mass_dir)
         os.makedirs(mass_dir)
         logging.debug('\t\t\t%s' % configstrings_dir)
@@ -109,10 +127,14 @@ def USBComposite(name=USB_DEV_NAME,
             f.write(name)
 
         # MAC addresses
-        with open(os.path.join(ecm_dir, 'host_addr'),'w+') as f:
+        with open(os.path.join(net_dir, 'host_addr'),'w+') as f:
             f.write(host_mac)
-        with open(os.path.join(ecm_dir, 'dev_addr'),'w+') as f:
+        with open(os.path.join(net_dir, 'dev_addr'),'w+') as f:
             f.write(dev_mac)
+        # queue length multiplier, only used at high speed and above
+        if qmult is not None:
+            with open(os.path.join(net_dir, 'qmult'),'w+') as f:
+                f.write(str(qmult))
 
         # mass storage
         with open(os.path.join(mass_dir, 'stall'), 'w+') as f:
@@ -128,27 +150,32 @@ def USBComposite(name=USB_DEV_NAME,
 
         # configs
         with open(os.path.join(configstrings_dir, 'configuration'),'w+') as f:
-            f.write('Config 1: ECM network')
+            f.write('Config 1: %s network' % function.upper())
         with open(os.path.join(configs_dir, 'MaxPower'), 'w+') as f:
             f.write('250')
-        os.symlink(os.path.join(functions_dir, 'ecm.usb0'),
-                   os.path.join(configs_dir, 'ecm.usb0'))
+        os.symlink(os.path.join(functions_dir, net_name),
+                   os.path.join(configs_dir, net_name))
         os.symlink(os.path.join(functions_dir, 'mass_storage.usb0'),
                    os.path.join(configs_dir, 'mass_storage.usb0'))
         os.system('ls /sys/class/udc > %s' % os.path.join(device_base, 'UDC'))
 
 def USBEther(host_mac='02:27:eb:b3:96:23',
-             dev_mac='06:27:eb:b3:96:23'):
-
-    logging.debug('\tLoading g_ether')
+             dev_mac='06:27:eb:b3:96:23',
+             function=USB_NET_FUNCTION,
+             qmult=None):
+
+    module, extras = USB_NET_MODULES[function]
+    cmd = ['modprobe', module,
+           'host_addr=' + host_mac, 'dev_addr=' + dev_mac] + extras
+    if qmult is not None:
+        cmd.append('qmult=%d' % qmult)
+    logging.debug('\tLoading %s' % module)
     try:
-        subprocess.check_output(['modprobe', 'g_ether',
-                                 'host_addr=' + host_mac, 'dev_addr=' + dev_mac],
-                                stderr=subprocess.STDOUT)
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
         logging.error('\tFailed: "%s" Aborting USB gadget config' % e.output.strip())
         if args.logfile:
-            sys.stderr.write('\tFailed to load g_ether: "%s" Aborting USB gadget config' % e.output.strip())
+            sys.stderr.write('\tFailed to load %s: "%s" Aborting USB gadget config' % (module, e.output.strip()))
 
 def USBMassStorage():
 
@@ -172,6 +199,56 @@ def USBSetStorage(storage, gadget_path):
         if args.logfile:
             sys.stderr.write('\tFailed to set mass storagebacking store')
 
+def checkStorage(image, full=False, update=True):
+    """
+    Check image for corruption with imagecheck.py, which must be loaded
+    returns (result, bad chunks), result is None if it couldn't be checked
+    """
+
+    logging.debug('\tChecking integrity of %s' % image)
+    try:
+        result, bad = imagecheck.check(image, full=full, update=update)
+    except (IOError, OSError, ValueError) as e:
+        logging.error('\tFailed to check %s (%s)' % (image, e))
+        if args.logfile:
+            sys.stderr.write('\tFailed to check %s (%s)' % (image, e))
+        return None, []
+    if result == imagecheck.CORRUPT:
+        logging.error('\t%s is corrupt (%d bad chunks)' % (image, len(bad)))
+        if args.logfile:
+            sys.stderr.write('\t%s is corrupt (%d bad chunks)' % (image, len(bad)))
+    return result, bad
+
+def USBStartDHCP(host_mac, iface=USB_NET_IFACE):
+    """
+    Start usb_dhcpd.py in the background to give the USB host
+    an address without waiting for link local fallback
+    """
+
+    cmd = [sys.executable, DHCP_SERVER, '-i', iface, '-m', host_mac,
+           '-l', args.logfile or DHCP_LOG]
+    if args.debug == logging.DEBUG:
+        cmd.append('-d')
+    logging.debug('\tStarting DHCP server: %s' % cmd)
+    try:
+        with open(os.devnull, 'r+') as null:
+            subprocess.Popen(cmd, stdin=null, stdout=null, stderr=null,
+                             close_fds=True, preexec_fn=os.setsid)
+    except OSError as e:
+        logging.error('\tFailed to start DHCP server (%s)' % e)
+        if args.logfile:
+            sys.stderr.write('\tFailed to start DHCP server (%s)' % e)
+
+def qmultArg(qmult):
+    """type handler for argparse"""
+    try:
+        v = int(qmult)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a number." % qmult)
+    if not USB_QMULT_RANGE[0] <= v <= USB_QMULT_RANGE[1]:
+        raise argparse.ArgumentTypeError("'%s' is out of range (%d - %d)." % ((qmult,) + USB_QMULT_RANGE))
+    return v
+
 
 ## Functions - hostname
 def validHostname(name):
@@ -291,6 +368,24 @@ def iAmNotRoot():
 ##    logging.debug('Checking UID')
     return not(os.geteuid() == 0)
 
+def py3Module(name, option):
+    """
+    Import name, one of the helper modules that need python 3
+    returns None if it can't be loaded, option is what needed it
+    """
+
+    if sys.version_info[0] < 3:
+        reason = 'this is python %d.%d' % sys.version_info[:2]
+    else:
+        try:
+            return __import__(name)
+        except ImportError as e:
+            reason = str(e)
+    logging.error('\t%s needs python 3 and %s (%s)' % (option, name, reason))
+    if args.logfile:
+        sys.stderr.write('\t%s needs python 3 and %s (%s)' % (option, name, reason))
+    return None
+
 def getSerial():
     """get serial number"""
     logging.info('Reading serial number')
@@ -413,6 +508,50 @@ usbgroup.add_argument('-E', '--noether',
                        action='store_true',
                        dest='noeth',
                        help="Don't start USB ethernet gadget.")
+parser.add_argument('-n', '--netfunc',
+                    action='store',
+                    dest='netfunc',
+                    default=USB_NET_FUNCTION,
+                    choices=sorted(USB_NET_MODULES),
+                    help="USB ethernet function. Defaults to '%(default)s'")
+parser.add_argument('-q', '--qmult',
+                    action='store',
+                    dest='qmult',
+                    default=None,
+                    type=qmultArg,
+                    help="USB ethernet queue length multiplier (%d - %d). Defaults to the kernel's own (5)" % USB_QMULT_RANGE)
+parser.add_argument('-s', '--storage',
+                    action='store',
+                    dest='storage',
+                    default=None,
+                    help="image to export over USB mass storage instead of one holding %s. May be zstd, xz or gzip compressed." % ID_FILE)
+parser.add_argument('-C', '--cache-dir',
+                    action='store',
+                    dest='cache_dir',
+                    default=IMAGE_CACHE_DIR,
+                    help="where compressed images are decompressed to, used for nothing else. Defaults to '%(default)s'")
+parser.add_argument('-S', '--cache-size',
+                    action='store',
+                    dest='cache_size',
+                    type=int,
+                    default=IMAGE_CACHE_SIZE,
+                    help="size limit of the decompressed image cache in MiB. Defaults to %(default)s")
+parser.add_argument('-V', '--verify',
+                    action='store_true',
+                    dest='verify',
+                    help="check the -s image against its chunk digests before exporting it. Hashes a sample of chunks unless the image has changed.")
+parser.add_argument('-A', '--verify-all',
+                    action='store_true',
+                    dest='verify_all',
+                    help="as -V but hash every chunk.")
+parser.add_argument('-X', '--refuse-corrupt',
+                    action='store_true',
+                    dest='refuse_corrupt',
+                    help="don't export the -s image if it fails verification. Implies -V.")
+parser.add_argument('-D', '--dhcp',
+                    action='store_true',
+                    dest='dhcp',
+                    help="Serve an address to the USB host over the ethernet gadget. Ignored if -U or -E specified.")
 parser.add_argument('-t','--test',
                     action='store_true',
                     help='Display changes but do not perform them.')
@@ -432,6 +571,14 @@ if args.logfile:
 logging.basicConfig(**loggerconfig)
 logging.debug('Command line args: %s' % args)
 
+# -A and -X only make sense with verification
+verify = args.verify or args.verify_all or args.refuse_corrupt
+imagecheck = None
+if verify and args.storage:
+    # imagecheck needs python 3, only load it when used
+    imagecheck = py3Module('imagecheck', '-V')
+    verify = imagecheck is not None
+
 try:
     # disable warnings
     # needed to surpress the warnigs from calls to os.tempnam
@@ -477,8 +624,35 @@ try:
             print('USB gadget(s) will be started:')
             if args.nomsg == False:
                 print('\tMass storage')
+                if args.storage:
+                    # imagecache needs python 3, only load it when used
+                    imagecache = py3Module('imagecache', '-s')
+                    if imagecache is None:
+                        print('\t\texporting %s: not possible, -s needs python 3' % args.storage)
+                    else:
+                        try:
+                            fmt = imagecache.compression(args.storage)
+                        except IOError as e:
+                            print('\t\texporting %s: can not be read (%s)' % (args.storage, e))
+                        else:
+                            if fmt:
+                                print('\t\texporting %s (%s compressed, decompressed into %s)' % (args.storage, fmt, args.cache_dir))
+                            else:
+                                print('\t\texporting %s' % args.storage)
+                            if verify:
+                                result, bad = checkStorage(args.storage, full=args.verify_all, update=False)
+                                print('\t\tintegrity: %s' % (result or 'could not be checked'))
+                                if bad:
+                                    print('\t\t\t%s chunk(s): %s' % (len(bad), ', '.join(str(i) for i in bad)))
+                                if result == imagecheck.CORRUPT and args.refuse_corrupt:
+                                    print('\t\tit will not be exported')
+                                elif fmt:
+                                    print('\t\tthe decompressed copy will be checked too')
             if args.noeth == False:
-                print('\tEthernet gadget with device MAC %s and host MAC %s' % (devicemac, hostmac))
+                print('\t%s ethernet gadget with device MAC %s and host MAC %s' % (args.netfunc.upper(), devicemac, hostmac))
+                if args.dhcp:
+                    print('\tDHCP server on %s, addresses derived from host MAC %s, log %s'
+                          % (USB_NET_IFACE, hostmac, args.logfile or DHCP_LOG))
         else:
             print('USB gadgets will not be started.')
     else:
@@ -490,18 +664,24 @@ try:
                              host_mac=hostmac,
                              dev_mac=devicemac,
                              storage='',
-                             devserial=serial)
+                             devserial=serial,
+                             function=args.netfunc,
+                             qmult=args.qmult)
                 export_msg = True
         elif args.noeth:
             USBMassStorage()
             export_msg = True
         elif args.nomsg:
             USBEther(host_mac=hostmac,
-                     dev_mac=devicemac)
+                     dev_mac=devicemac,
+                     function=args.netfunc,
+                     qmult=args.qmult)
         elif args.nousb:
             logging.debug('USB gadgets disabled on command line')
         else:
             logging.debug('THIS SHOULD NEVER BE SEEN')
+        if args.dhcp and not (args.nousb or args.noeth):
+            USBStartDHCP(hostmac)
         
 ##    if args.nousb:
 ##        pass
@@ -521,26 +701,63 @@ try:
 ##
     if export_msg:
         # backing store
-        logging.debug('Creating mass_storage backingstore')
-        # create it
-        storage = makeStorage()
-        logging.debug('\t%s' % storage)
-        # mount it
-        logging.debug('\tCreating mount point')
-        mount_point = os.tempnam()
-        os.mkdir(mount_point)
-        logging.debug('\tmounting')
-        subprocess.check_call(['mount', storage, mount_point])
-        # copy files
-        logging.debug('\tcopying files')
-        logging.debug('\t\t%s' % os.path.join(ID_PATH, ID_FILE))
-        subprocess.call(['cp', os.path.join(ID_PATH, ID_FILE), os.path.join(mount_point, ID_FILE)])
-        # unmount it
-        logging.debug('\tunmounting')
-        subprocess.check_call(['umount', mount_point])
-        # delete mount point
-        logging.debug('\tdeleting mount point')
-        os.rmdir(mount_point)
+        if args.storage:
+            logging.debug('Using mass_storage backingstore %s' % args.storage)
+            result = None
+            if verify:
+                result, bad = checkStorage(args.storage, full=args.verify_all)
+            if verify and result == imagecheck.CORRUPT and args.refuse_corrupt:
+                logging.error('\tNot exporting %s' % args.storage)
+                storage = ''
+            else:
+                # imagecache needs python 3, only load it when used
+                imagecache = py3Module('imagecache', '-s')
+                if imagecache is None:
+                    logging.error('\tNot exporting %s' % args.storage)
+                    storage = ''
+                else:
+                    try:
+                        storage = imagecache.cachedImage(args.storage,
+                                                         cache_dir=args.cache_dir,
+                                                         cache_size=args.cache_size)
+                        if verify and storage != args.storage:
+                            # the decompressed copy is what the host sees and
+                            # it lives on the same card, check it too
+                            result, bad = checkStorage(storage, full=args.verify_all)
+                            if result == imagecheck.CORRUPT:
+                                logging.warning('\tDecompressing %s again' % args.storage)
+                                imagecache.discard(storage)
+                                storage = imagecache.cachedImage(args.storage,
+                                                                 cache_dir=args.cache_dir,
+                                                                 cache_size=args.cache_size)
+                                result, bad = checkStorage(storage, full=args.verify_all)
+                    except (IOError, OSError, RuntimeError) as e:
+                        logging.error('\tFailed to prepare %s (%s)' % (args.storage, e))
+                        if args.logfile:
+                            sys.stderr.write('\tFailed to prepare %s (%s)' % (args.storage, e))
+                        storage = ''
+            logging.debug('\t%s' % storage)
+        else:
+            logging.debug('Creating mass_storage backingstore')
+            # create it
+            storage = makeStorage()
+            logging.debug('\t%s' % storage)
+            # mount it
+            logging.debug('\tCreating mount point')
+            mount_point = os.tempnam()
+            os.mkdir(mount_point)
+            logging.debug('\tmounting')
+            subprocess.check_call(['mount', storage, mount_point])
+            # copy files
+            logging.debug('\tcopying files')
+            logging.debug('\t\t%s' % os.path.join(ID_PATH, ID_FILE))
+            subprocess.call(['cp', os.path.join(ID_PATH, ID_FILE), os.path.join(mount_point, ID_FILE)])
+            # unmount it
+            logging.debug('\tunmounting')
+            subprocess.check_call(['umount', mount_point])
+            # delete mount point
+            logging.debug('\tdeleting mount point')
+            os.rmdir(mount_point)
         # export it
         logging.debug('\texporting')
         if args.noether:
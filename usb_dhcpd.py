@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""
+minimal DHCP server for the USB ethernet gadget
+
+Hands out a single lease to a single client, the USB host, so it can
+reach the device as soon as the gadget comes up instead of waiting for
+link local fallback. Nothing to install, no dnsmasq.
+
+The link is point to point so whoever asks is the USB host and gets the
+lease, whatever its MAC address. Not every function passes host_addr
+on to the host (EEM doesn't), so the MAC can't be relied on.
+
+Both addresses are derived from the host MAC address (see make_mac() in
+set_id.py) so they are the same on every boot:
+    device  10.<5th byte>.<6th byte>.1
+    host    10.<5th byte>.<6th byte>.2
+No router or DNS server is offered so the host keeps using its own.
+
+Must be run as root. Normally started by set_id.py -D.
+"""
+
+## Imports
+import argparse
+import logging
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+
+## Globals
+# logging
+LOG_LEVEL = logging.WARNING
+# network
+INTERFACE = 'usb0'
+SERVER_PORT = 67
+CLIENT_PORT = 68
+LEASE_TIME = 86400
+NETMASK = '255.255.255.0'
+PREFIX_LENGTH = 24
+# how long to wait for the interface to appear (seconds)
+IFACE_WAIT = 10
+# SO_BINDTODEVICE is not exported by the socket module on all versions
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+# DHCP
+BOOTREQUEST = 1
+BOOTREPLY = 2
+MAGIC_COOKIE = b'\x63\x82\x53\x63'
+HEADER = struct.Struct('!BBBBIHHIIII16s64s128s')
+DISCOVER, OFFER, REQUEST, DECLINE, ACK, NAK, RELEASE, INFORM = range(1, 9)
+MESSAGE_NAMES = {DISCOVER: 'DISCOVER', OFFER: 'OFFER', REQUEST: 'REQUEST',
+                 DECLINE: 'DECLINE', ACK: 'ACK', NAK: 'NAK',
+                 RELEASE: 'RELEASE', INFORM: 'INFORM'}
+OPT_PAD = 0
+OPT_SUBNET_MASK = 1
+OPT_REQUESTED_IP = 50
+OPT_LEASE_TIME = 51
+OPT_MESSAGE_TYPE = 53
+OPT_SERVER_ID = 54
+OPT_RENEWAL_TIME = 58
+OPT_REBINDING_TIME = 59
+OPT_END = 255
+
+
+## Functions - addresses
+def parseMac(mac):
+    """'02:27:eb:b3:96:23' -> 6 bytes"""
+    raw = bytes(bytearray(int(b, 16) for b in mac.split(':')))
+    if len(raw) != 6:
+        raise ValueError('invalid MAC address "%s"' % mac)
+    return raw
+
+def formatMac(raw):
+    return ':'.join('%02x' % b for b in bytearray(raw))
+
+def leaseAddresses(hostmac):
+    """
+    Calculate server and client addresses from the host MAC
+    returns (server, client) as dotted quads
+    """
+
+    raw = bytearray(parseMac(hostmac))
+    network = '10.%d.%d.' % (raw[4], raw[5])
+    return network + '1', network + '2'
+
+def macArg(mac):
+    """type handler for argparse"""
+    try:
+        parseMac(mac)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a valid MAC address." % mac)
+    return mac.lower()
+
+
+## Functions - packets
+def parseOptions(data):
+    """parse DHCP options into a dict of code: bytes"""
+    options = {}
+    i = 0
+    while i < len(data):
+        code = data[i]
+        if code == OPT_END:
+            break
+        if code == OPT_PAD:
+            i += 1
+            continue
+        if i + 1 >= len(data):
+            break
+        length = data[i + 1]
+        options[code] = bytes(data[i + 2:i + 2 + length])
+        i += 2 + length
+    return options
+
+def parsePacket(packet):
+    """
+    Parse a BOOTP/DHCP packet
+    returns a dict or None if it is not a DHCP request
+    """
+
+    if len(packet) < HEADER.size + len(MAGIC_COOKIE):
+        return None
+    (op, htype, hlen, hops, xid, secs, flags,
+     ciaddr, yiaddr, siaddr, giaddr, chaddr, sname, bootfile) = HEADER.unpack_from(packet)
+    if op != BOOTREQUEST or htype != 1 or hlen != 6:
+        return None
+    if packet[HEADER.size:HEADER.size + 4] != MAGIC_COOKIE:
+        return None
+    options = parseOptions(bytearray(packet[HEADER.size + 4:]))
+    if OPT_MESSAGE_TYPE not in options:
+        return None
+    return {'type': bytearray(options[OPT_MESSAGE_TYPE])[0],
+            'xid': xid,
+            'flags': flags,
+            'ciaddr': ciaddr,
+            'giaddr': giaddr,
+            'chaddr': chaddr[:6],
+            'options': options}
+
+def buildReply(request, msgtype, server, client, lease_time=LEASE_TIME):
+    """Build an OFFER, ACK or NAK for request"""
+    if msgtype == NAK:
+        yiaddr = 0
+    else:
+        yiaddr = struct.unpack('!I', socket.inet_aton(client))[0]
+    header = HEADER.pack(BOOTREPLY, 1, 6, 0, request['xid'], 0, request['flags'],
+                         request['ciaddr'] if msgtype == ACK else 0,
+                         yiaddr, 0, request['giaddr'],
+                         request['chaddr'].ljust(16, b'\x00'), b'', b'')
+    options = [(OPT_MESSAGE_TYPE, struct.pack('!B', msgtype)),
+               (OPT_SERVER_ID, socket.inet_aton(server))]
+    if msgtype != NAK:
+        options += [(OPT_LEASE_TIME, struct.pack('!I', lease_time)),
+                    (OPT_RENEWAL_TIME, struct.pack('!I', lease_time // 2)),
+                    (OPT_REBINDING_TIME, struct.pack('!I', lease_time * 7 // 8)),
+                    (OPT_SUBNET_MASK, socket.inet_aton(NETMASK))]
+    raw = b''.join(struct.pack('!BB', code, len(value)) + value
+                   for code, value in options)
+    return header + MAGIC_COOKIE + raw + struct.pack('!B', OPT_END)
+
+
+## Functions - server
+def waitForInterface(iface, timeout=IFACE_WAIT):
+    """wait for iface to exist, returns True if it does"""
+    deadline = time.time() + timeout
+    while not os.path.exists(os.path.join('/sys/class/net', iface)):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+def configureInterface(iface, server):
+    """give iface the server address and bring it up"""
+    logging.debug('\tSetting %s address to %s/%d' % (iface, server, PREFIX_LENGTH))
+    for cmd in (['ip', 'addr', 'replace', '%s/%d' % (server, PREFIX_LENGTH), 'dev', iface],
+                ['ip', 'link', 'set', iface, 'up']):
+        try:
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            logging.error('\t%s failed: "%s"' % (' '.join(cmd), e.output.strip()))
+            return False
+    return True
+
+def openSocket(iface):
+    """
+    UDP socket on the server port bound to iface
+    no SO_REUSEADDR so a second server fails with EADDRINUSE
+    """
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    s.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, iface.encode() + b'\x00')
+    s.bind(('', SERVER_PORT))
+    return s
+
+def serve(sock, server, client, lease_time=LEASE_TIME):
+    """Answer requests forever"""
+    leased = socket.inet_aton(client)
+    # xid: time DISCOVER was received, for DISCOVER to ACK latency
+    pending = {}
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    logging.info('Serving %s' % client)
+    while True:
+        poller.poll()
+        packet, source = sock.recvfrom(4096)
+        received = time.time()
+        request = parsePacket(packet)
+        if request is None:
+            continue
+        name = MESSAGE_NAMES.get(request['type'], str(request['type']))
+        hostmac = formatMac(request['chaddr'])
+        logging.debug('\t%s xid %08x from %s' % (name, request['xid'], hostmac))
+
+        if request['type'] == DISCOVER:
+            pending[request['xid']] = received
+            reply = OFFER
+        elif request['type'] == REQUEST:
+            # requested address is in option 50 when selecting/rebooting
+            # and in ciaddr when renewing/rebinding
+            wanted = request['options'].get(OPT_REQUESTED_IP,
+                                            struct.pack('!I', request['ciaddr']))
+            server_id = request['options'].get(OPT_SERVER_ID)
+            if server_id is not None and server_id != socket.inet_aton(server):
+                # client chose another server
+                pending.pop(request['xid'], None)
+                continue
+            reply = ACK if wanted == leased else NAK
+        elif request['type'] in (RELEASE, DECLINE):
+            logging.info('%s of %s by %s' % (name, client, hostmac))
+            continue
+        else:
+            continue
+
+        data = buildReply(request, reply, server, client, lease_time)
+        if request['ciaddr'] and reply == ACK:
+            destination = (socket.inet_ntoa(struct.pack('!I', request['ciaddr'])), CLIENT_PORT)
+        else:
+            destination = ('255.255.255.255', CLIENT_PORT)
+        sock.sendto(data, destination)
+        logging.debug('\t%s sent to %s' % (MESSAGE_NAMES[reply], destination[0]))
+
+        if reply == ACK:
+            started = pending.pop(request['xid'], None)
+            if started is None:
+                logging.info('Lease %s renewed by %s' % (client, hostmac))
+            else:
+                logging.info('Lease %s to %s, DISCOVER to ACK %.1f ms'
+                             % (client, hostmac, (time.time() - started) * 1000))
+        elif reply == NAK:
+            pending.pop(request['xid'], None)
+            logging.warning('NAK to %s for %s' % (hostmac, socket.inet_ntoa(wanted)))
+        # forget DISCOVERs that never got a REQUEST
+        for xid in [x for x, t in pending.items() if received - t > 60]:
+            del pending[xid]
+
+
+## Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Minimal single lease DHCP server for the USB ethernet gadget.\nMust be run as root or with sudo.',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-m', '--hostmac',
+                        action='store',
+                        required=True,
+                        type=macArg,
+                        help='MAC address of the USB host. Addresses are derived from it.')
+    parser.add_argument('-i', '--interface',
+                        action='store',
+                        default=INTERFACE,
+                        help="interface to serve. Defaults to '%(default)s'")
+    parser.add_argument('-L', '--lease',
+                        action='store',
+                        type=int,
+                        default=LEASE_TIME,
+                        help='lease time in seconds. Defaults to %(default)s')
+    parser.add_argument('-d', '--debug',
+                        action='store_const',
+                        dest='debug',
+                        const=logging.DEBUG,
+                        default=logging.INFO,
+                        help='Enable debug output')
+    parser.add_argument('-l', '--logfile',
+                        action='store',
+                        default=None,
+                        help='log file.')
+    parser.add_argument('-t', '--test',
+                        action='store_true',
+                        help='Display addresses but do not start the server.')
+    args = parser.parse_args()
+
+    loggerconfig = {'format':'%(asctime)s %(levelname)s\t: %(message)s',
+                    'level':args.debug}
+    if args.logfile:
+        loggerconfig['filename'] = args.logfile
+    logging.basicConfig(**loggerconfig)
+    logging.debug('Command line args: %s' % args)
+
+    server, client = leaseAddresses(args.hostmac)
+    if args.test:
+        print('Device %s on %s, host gets %s/%d' % (server, args.interface,
+                                                    client, PREFIX_LENGTH))
+        sys.exit()
+
+    if os.geteuid() != 0:
+        sys.exit('Must be root')
+
+    try:
+        if not waitForInterface(args.interface):
+            sys.exit('Interface %s not found' % args.interface)
+        if not configureInterface(args.interface, server):
+            sys.exit('Failed to configure %s' % args.interface)
+        serve(openSocket(args.interface), server, client, args.lease)
+    except KeyboardInterrupt:
+        pass
+    except:
+        logging.exception('Uncaught exception: ')
+        raise
+    finally:
+        logging.shutdown()
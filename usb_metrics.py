@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+"""
+export USB gadget, network link and backing store metrics
+in the Prometheus textfile format
+
+Samples
+    /sys/class/udc/*/state and current_speed
+    /sys/class/net/usb0/statistics/*
+    /sys/block/*/stat for the device holding the mass storage backing store
+    the gadget configuration under /sys/kernel/config/usb_gadget
+
+sysfs attributes are kept open and re-read with os.pread so a sample
+costs no new opens. configfs caches an attribute's contents per open
+file so the gadget configuration is re-read with a fresh open, but only
+every RESCAN seconds. That is also when the UDC and backing store
+device are looked up again.
+
+Point node_exporter's textfile collector at the output directory.
+"""
+
+## Imports
+import argparse
+import logging
+import os
+import stat
+import time
+
+
+## Globals
+# logging
+LOG_LEVEL = logging.WARNING
+# USB gadget config, must match set_id.py
+USB_BASE_DIR = '/sys/kernel/config/usb_gadget'
+USB_DEV_NAME = 'foo'
+USB_NET_IFACE = 'usb0'
+UDC_DIR = '/sys/class/udc'
+NET_DIR = '/sys/class/net'
+# output
+OUTPUT_FILE = '/var/lib/prometheus/node-exporter/usb_gadget.prom'
+INTERVAL = 15
+RESCAN = 60
+# from usb_state_string() in the kernel
+UDC_STATES = ('not attached', 'attached', 'powered', 'reconnecting',
+              'unauthenticated', 'default', 'addressed', 'configured',
+              'suspended')
+NET_STATS = ('rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets',
+             'rx_errors', 'tx_errors', 'rx_dropped', 'tx_dropped')
+# /sys/block/*/stat fields: (index, metric name, scale)
+# see Documentation/block/stat.rst
+SECTOR_SIZE = 512
+BLOCK_STATS = ((0, 'reads_completed_total', 1),
+               (2, 'read_bytes_total', SECTOR_SIZE),
+               (3, 'read_time_seconds_total', 0.001),
+               (4, 'writes_completed_total', 1),
+               (6, 'written_bytes_total', SECTOR_SIZE),
+               (7, 'write_time_seconds_total', 0.001),
+               (8, 'io_now', 1),
+               (9, 'io_time_seconds_total', 0.001))
+
+
+## Functions - reading
+def readAttr(fds, path):
+    """
+    Read a sysfs attribute through a cached file descriptor
+    returns the stripped contents or None if it can't be read
+    """
+
+    fd = fds.get(path)
+    try:
+        if fd is None:
+            fd = os.open(path, os.O_RDONLY)
+            fds[path] = fd
+        return os.pread(fd, 4096, 0).decode('utf-8', 'replace').strip()
+    except OSError:
+        # attribute gone (e.g. usb0 removed) or not readable right now
+        # (e.g. carrier on a down interface)
+        if fd is not None:
+            closeAttr(fds, path)
+        return None
+
+def closeAttr(fds, path):
+    fd = fds.pop(path, None)
+    if fd is not None:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+def closeAll(fds):
+    for path in list(fds):
+        closeAttr(fds, path)
+
+def readConfig(path):
+    """Read a configfs attribute, returns '' if it can't be read"""
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return ''
+
+def blockDevice(backing_file):
+    """
+    Find the block device holding backing_file
+    returns (name, path to its stat file) or None
+    """
+
+    try:
+        st = os.stat(backing_file)
+    except OSError:
+        return None
+    dev = st.st_rdev if stat.S_ISBLK(st.st_mode) else st.st_dev
+    sysdir = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+    statfile = os.path.join(sysdir, 'stat')
+    if not os.path.isfile(statfile):
+        # e.g. tmpfs, no block device behind it
+        return None
+    return os.path.basename(os.path.realpath(sysdir)), statfile
+
+def discover(gadget=USB_DEV_NAME, iface=USB_NET_IFACE):
+    """
+    Read the gadget configuration
+    returns a dict describing what to sample
+    """
+
+    device_base = os.path.join(USB_BASE_DIR, gadget)
+    functions_dir = os.path.join(device_base, 'functions')
+    config = {'gadget': gadget,
+              'present': os.path.isdir(device_base),
+              'udc': readConfig(os.path.join(device_base, 'UDC')),
+              'functions': [],
+              'luns': [],
+              'block': None,
+              'iface': iface}
+    config['bound'] = bool(config['udc'])
+    if not config['udc']:
+        # not bound (or a legacy g_* module), watch the first UDC there is
+        try:
+            udcs = sorted(os.listdir(UDC_DIR))
+        except OSError:
+            udcs = []
+        config['udc'] = udcs[0] if udcs else ''
+    if config['present']:
+        try:
+            config['functions'] = sorted(os.listdir(functions_dir))
+        except OSError:
+            pass
+    for function in config['functions']:
+        if not function.startswith('mass_storage.'):
+            continue
+        mass_dir = os.path.join(functions_dir, function)
+        for lun in sorted(l for l in os.listdir(mass_dir) if l.startswith('lun.')):
+            lun_dir = os.path.join(mass_dir, lun)
+            backing = readConfig(os.path.join(lun_dir, 'file'))
+            config['luns'].append({'function': function,
+                                   'lun': lun,
+                                   'file': backing,
+                                   'ro': readConfig(os.path.join(lun_dir, 'ro')) == '1'})
+            if backing and config['block'] is None:
+                config['block'] = blockDevice(backing)
+    logging.debug('Configuration: %s' % config)
+    return config
+
+
+## Functions - output
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(**kw):
+    return '{%s}' % ','.join('%s="%s"' % (k, escape(str(v))) for k, v in sorted(kw.items()))
+
+def collect(fds, config):
+    """Sample everything in config, returns the metric lines"""
+    out = []
+    add = out.append
+
+    # gadget configuration
+    add('# HELP usb_gadget_present Gadget exists in configfs.')
+    add('# TYPE usb_gadget_present gauge')
+    add('usb_gadget_present%s %d' % (labels(gadget=config['gadget']), config['present']))
+    add('# HELP usb_gadget_bound Gadget is bound to a UDC.')
+    add('# TYPE usb_gadget_bound gauge')
+    add('usb_gadget_bound%s %d' % (labels(gadget=config['gadget']), config['bound']))
+    add('# HELP usb_gadget_function_info Functions in the gadget.')
+    add('# TYPE usb_gadget_function_info gauge')
+    for function in config['functions']:
+        add('usb_gadget_function_info%s 1' % labels(gadget=config['gadget'], function=function))
+    add('# HELP usb_gadget_lun_info Mass storage LUNs and their backing store.')
+    add('# TYPE usb_gadget_lun_info gauge')
+    for lun in config['luns']:
+        add('usb_gadget_lun_info%s 1' % labels(function=lun['function'], lun=lun['lun'],
+                                                file=lun['file'], ro=int(lun['ro'])))
+
+    # UDC
+    udc = config['udc']
+    if udc:
+        udc_dir = os.path.join(UDC_DIR, udc)
+        state = readAttr(fds, os.path.join(udc_dir, 'state'))
+        speed = readAttr(fds, os.path.join(udc_dir, 'current_speed'))
+        if state is not None:
+            add('# HELP usb_gadget_host_attached USB host is attached.')
+            add('# TYPE usb_gadget_host_attached gauge')
+            add('usb_gadget_host_attached%s %d' % (labels(udc=udc), state != 'not attached'))
+            add('# HELP usb_gadget_udc_state UDC state, 1 for the current one.')
+            add('# TYPE usb_gadget_udc_state gauge')
+            for s in UDC_STATES:
+                add('usb_gadget_udc_state%s %d' % (labels(udc=udc, state=s), state == s))
+        if speed is not None:
+            add('# HELP usb_gadget_udc_speed_info Current UDC speed.')
+            add('# TYPE usb_gadget_udc_speed_info gauge')
+            add('usb_gadget_udc_speed_info%s 1' % labels(udc=udc, speed=speed))
+
+    # network
+    iface = config['iface']
+    stats_dir = os.path.join(NET_DIR, iface, 'statistics')
+    carrier = readAttr(fds, os.path.join(NET_DIR, iface, 'carrier'))
+    if carrier is not None:
+        add('# HELP usb_gadget_net_carrier Carrier state of the gadget interface.')
+        add('# TYPE usb_gadget_net_carrier gauge')
+        add('usb_gadget_net_carrier%s %s' % (labels(interface=iface), carrier))
+    for name in NET_STATS:
+        value = readAttr(fds, os.path.join(stats_dir, name))
+        if value is None:
+            continue
+        metric = 'usb_gadget_net_%s_total' % name
+        add('# TYPE %s counter' % metric)
+        add('%s%s %s' % (metric, labels(interface=iface), value))
+
+    # backing store
+    if config['block'] is not None:
+        device, statfile = config['block']
+        fields = readAttr(fds, statfile)
+        if fields is not None:
+            fields = fields.split()
+            for index, name, scale in BLOCK_STATS:
+                metric = 'usb_gadget_storage_%s' % name
+                kind = 'gauge' if name == 'io_now' else 'counter'
+                add('# TYPE %s %s' % (metric, kind))
+                if scale == 1:
+                    add('%s%s %s' % (metric, labels(device=device), fields[index]))
+                else:
+                    add('%s%s %.3f' % (metric, labels(device=device), int(fields[index]) * scale))
+    return out
+
+def writeMetrics(lines, output):
+    """Write lines to output atomically"""
+    tmp = '%s.%d.tmp' % (output, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines))
+        f.write('\n')
+    os.rename(tmp, output)
+
+def run(output, interval=INTERVAL, rescan=RESCAN,
+        gadget=USB_DEV_NAME, iface=USB_NET_IFACE, once=False):
+    fds = {}
+    config = None
+    last_scan = 0
+    next_sample = time.time()
+    try:
+        while True:
+            now = time.time()
+            if config is None or now - last_scan >= rescan:
+                # fresh descriptors too, sysfs files may have been replaced
+                closeAll(fds)
+                config = discover(gadget, iface)
+                last_scan = now
+            cpu = time.process_time()
+            lines = collect(fds, config)
+            cpu = time.process_time() - cpu
+            lines += ['# HELP usb_gadget_scrape_cpu_seconds CPU time spent on the last sample.',
+                      '# TYPE usb_gadget_scrape_cpu_seconds gauge',
+                      'usb_gadget_scrape_cpu_seconds %.6f' % cpu]
+            writeMetrics(lines, output)
+            logging.debug('Sample took %.3f ms CPU' % (cpu * 1000))
+            if once:
+                break
+            next_sample += interval
+            delay = next_sample - time.time()
+            if delay < 0:
+                # fell behind (e.g. system was suspended), don't try to catch up
+                next_sample = time.time()
+                delay = 0
+            time.sleep(delay)
+    finally:
+        closeAll(fds)
+
+
+## Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export USB gadget metrics in the Prometheus textfile format.')
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        default=OUTPUT_FILE,
+                        help="output file. Defaults to '%(default)s'")
+    parser.add_argument('-i', '--interval',
+                        action='store',
+                        type=float,
+                        default=INTERVAL,
+                        help='seconds between samples. Defaults to %(default)s')
+    parser.add_argument('-r', '--rescan',
+                        action='store',
+                        type=float,
+                        default=RESCAN,
+                        help='seconds between re-reading the gadget configuration. Defaults to %(default)s')
+    parser.add_argument('-g', '--gadget',
+                        action='store',
+                        default=USB_DEV_NAME,
+                        help="configfs gadget name. Defaults to '%(default)s'")
+    parser.add_argument('-n', '--interface',
+                        action='store',
+                        default=USB_NET_IFACE,
+                        help="gadget network interface. Defaults to '%(default)s'")
+    parser.add_argument('-1', '--once',
+                        action='store_true',
+                        help='write one sample and exit')
+    parser.add_argument('-d', '--debug',
+                        action='store_const',
+                        dest='debug',
+                        const=logging.DEBUG,
+                        default=LOG_LEVEL,
+                        help='Enable debug output')
+    parser.add_argument('-l', '--logfile',
+                        action='store',
+                        default=None,
+                        help="log file. This is only useful with -d")
+    args = parser.parse_args()
+
+    loggerconfig = {'format':'%(levelname)s\t: %(message)s',
+                    'level':args.debug}
+    if args.logfile:
+        loggerconfig['filename'] = args.logfile
+    logging.basicConfig(**loggerconfig)
+    logging.debug('Command line args: %s' % args)
+
+    try:
+        run(args.output, args.interval, args.rescan,
+            args.gadget, args.interface, args.once)
+    except KeyboardInterrupt:
+        pass
+    except:
+        logging.exception('Uncaught exception: ')
+        raise
+    finally:
+        logging.shutdown()
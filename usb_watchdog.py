@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+"""
+watch the USB device controller (UDC) for host attach/detach/suspend
+and act on it
+
+Blocks in poll() on /sys/class/udc/<udc>/state, which the kernel
+notifies on every change, so it uses no CPU while nothing happens.
+A new state must hold for DEBOUNCE seconds before it counts, which
+hides the flurry of states seen while the host enumerates the gadget.
+
+Events:
+    attach      state became 'configured'
+    detach      state became 'not attached'
+    suspend     state became 'suspended'
+    stuck       host is there but the gadget has not been configured
+                after STUCK seconds, e.g. after a host reset
+
+Actions:
+    rebind      unbind and rebind the gadget to the UDC
+    refresh     eject and re-insert every mass storage backing store
+                so the host re-reads the image
+    restartnet  bounce the gadget network interface
+    anything else is run with the shell, with USB_EVENT, USB_UDC and
+    USB_UDC_STATE set in its environment
+
+Actions are rate limited to LIMIT runs per WINDOW seconds.
+
+Must be run as root.
+"""
+
+## Imports
+import argparse
+import collections
+import glob
+import logging
+import os
+import select
+import subprocess
+import sys
+import time
+
+
+## Globals
+# logging
+LOG_LEVEL = logging.INFO
+# USB gadget config, must match set_id.py
+USB_BASE_DIR = '/sys/kernel/config/usb_gadget'
+USB_DEV_NAME = 'foo'
+USB_NET_IFACE = 'usb0'
+UDC_DIR = '/sys/class/udc'
+# timing (seconds)
+DEBOUNCE = 2.0
+STUCK = 10.0
+# rate limiting
+LIMIT = 3
+WINDOW = 60.0
+# how long to wait before looking for a UDC that has gone away
+UDC_RETRY = 5.0
+# state -> event
+EVENTS = {'configured': 'attach',
+          'not attached': 'detach',
+          'suspended': 'suspend'}
+# host present but gadget not configured
+STUCK_STATES = ('attached', 'powered', 'reconnecting', 'unauthenticated',
+                'default', 'addressed')
+ACTIONS = ('rebind', 'refresh', 'restartnet')
+
+
+## Functions - gadget
+def findUDC(gadget=USB_DEV_NAME):
+    """UDC the gadget is bound to, or the first there is"""
+    try:
+        with open(os.path.join(USB_BASE_DIR, gadget, 'UDC'), 'r') as f:
+            udc = f.read().strip()
+        if udc:
+            return udc
+    except (IOError, OSError):
+        pass
+    try:
+        udcs = sorted(os.listdir(UDC_DIR))
+    except OSError:
+        return None
+    return udcs[0] if udcs else None
+
+def writeAttr(path, value):
+    logging.debug('\t\t%s <- "%s"' % (path, value))
+    with open(path, 'w') as f:
+        f.write(value)
+
+def rebind(udc, gadget=USB_DEV_NAME):
+    udc_file = os.path.join(USB_BASE_DIR, gadget, 'UDC')
+    if os.path.isfile(udc_file):
+        writeAttr(udc_file, '')
+        time.sleep(0.5)
+        writeAttr(udc_file, udc)
+    else:
+        # legacy g_* module, no configfs gadget to rebind
+        soft_connect = os.path.join(UDC_DIR, udc, 'soft_connect')
+        writeAttr(soft_connect, 'disconnect')
+        time.sleep(0.5)
+        writeAttr(soft_connect, 'connect')
+
+def lunFiles(udc, gadget=USB_DEV_NAME):
+    """'file' attributes of every mass storage LUN"""
+    luns = glob.glob(os.path.join(USB_BASE_DIR, gadget, 'functions',
+                                  'mass_storage.*', 'lun.*', 'file'))
+    if not luns:
+        # legacy g_mass_storage/g_multi
+        luns = glob.glob(os.path.join(UDC_DIR, udc, 'device', 'gadget*', 'lun*', 'file'))
+    return sorted(luns)
+
+def refresh(udc, gadget=USB_DEV_NAME):
+    for lun_file in lunFiles(udc, gadget):
+        with open(lun_file, 'r') as f:
+            storage = f.read().strip()
+        if not storage:
+            continue
+        forced_eject = os.path.join(os.path.dirname(lun_file), 'forced_eject')
+        if os.path.isfile(forced_eject):
+            writeAttr(forced_eject, '1')
+        else:
+            writeAttr(lun_file, '')
+        writeAttr(lun_file, storage)
+
+def restartNet(iface=USB_NET_IFACE):
+    for state in ('down', 'up'):
+        subprocess.check_output(['ip', 'link', 'set', iface, state],
+                                stderr=subprocess.STDOUT)
+
+def runAction(action, event, udc, state, gadget=USB_DEV_NAME, iface=USB_NET_IFACE):
+    """Run one action, returns True if it succeeded"""
+    logging.info('\t%s: %s' % (event, action))
+    try:
+        if action == 'rebind':
+            rebind(udc, gadget)
+        elif action == 'refresh':
+            refresh(udc, gadget)
+        elif action == 'restartnet':
+            restartNet(iface)
+        else:
+            env = dict(os.environ, USB_EVENT=event, USB_UDC=udc, USB_UDC_STATE=state)
+            subprocess.check_output(action, shell=True, env=env,
+                                    stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        logging.error('\t\tFailed: "%s"' % e.output.strip())
+        return False
+    except (IOError, OSError) as e:
+        logging.error('\t\tFailed: %s' % e)
+        return False
+    return True
+
+
+## Functions - watching
+def readState(fd):
+    # reading from offset 0 also re-arms the poll notification
+    return os.pread(fd, 64, 0).decode('ascii', 'replace').strip()
+
+def watch(udc, actions, gadget=USB_DEV_NAME, iface=USB_NET_IFACE,
+          debounce=DEBOUNCE, stuck=STUCK, limit=LIMIT, window=WINDOW):
+    """
+    Watch udc until it goes away
+    actions is a dict of event: [action, ...]
+    """
+
+    fd = os.open(os.path.join(UDC_DIR, udc, 'state'), os.O_RDONLY)
+    poller = select.poll()
+    poller.register(fd, select.POLLPRI | select.POLLERR)
+    runs = collections.deque()
+    try:
+        settled = readState(fd)
+        logging.info('Watching %s, state "%s"' % (udc, settled))
+        pending = None
+        deadline = None
+        while True:
+            if deadline is None:
+                # nothing pending, sleep until the kernel says otherwise
+                timeout = None
+            else:
+                timeout = max(0, int((deadline - time.time()) * 1000))
+            if poller.poll(timeout):
+                state = readState(fd)
+                logging.debug('\tstate "%s"' % state)
+                if state == settled:
+                    pending = deadline = None
+                elif state != pending:
+                    # moving between stuck states doesn't restart the clock
+                    if not (pending in STUCK_STATES and state in STUCK_STATES):
+                        wait = stuck if state in STUCK_STATES else debounce
+                        deadline = time.time() + wait
+                    pending = state
+                continue
+            if deadline is None or time.time() < deadline:
+                continue
+
+            # pending state has held long enough
+            previous, settled = settled, pending
+            pending = deadline = None
+            event = 'stuck' if settled in STUCK_STATES else EVENTS.get(settled)
+            logging.info('%s: "%s" -> "%s"%s' % (udc, previous, settled,
+                                                 ' (%s)' % event if event else ''))
+            if not actions.get(event):
+                continue
+            now = time.time()
+            while runs and now - runs[0] > window:
+                runs.popleft()
+            if len(runs) >= limit:
+                logging.warning('\tRate limit reached (%d in %ds), not acting on %s'
+                                % (limit, window, event))
+                continue
+            runs.append(now)
+            for action in actions[event]:
+                runAction(action, event, udc, settled, gadget, iface)
+    finally:
+        os.close(fd)
+
+
+## Main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Act on USB host attach, detach, suspend and stuck enumeration.\nMust be run as root or with sudo.',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="""\
+ACTION is one of %s or a shell command.
+Each --on-* option can be given more than once, actions run in order.
+
+Default: --on-stuck rebind""" % ', '.join(ACTIONS))
+    for event in ('attach', 'detach', 'suspend', 'stuck'):
+        parser.add_argument('--on-%s' % event,
+                            action='append',
+                            dest='on_%s' % event,
+                            metavar='ACTION',
+                            default=None,
+                            help='action to run on %s.' % event)
+    parser.add_argument('-u', '--udc',
+                        action='store',
+                        default=None,
+                        help="UDC to watch. Defaults to the one the gadget is bound to")
+    parser.add_argument('-g', '--gadget',
+                        action='store',
+                        default=USB_DEV_NAME,
+                        help="configfs gadget name. Defaults to '%(default)s'")
+    parser.add_argument('-n', '--interface',
+                        action='store',
+                        default=USB_NET_IFACE,
+                        help="gadget network interface. Defaults to '%(default)s'")
+    parser.add_argument('-b', '--debounce',
+                        action='store',
+                        type=float,
+                        default=DEBOUNCE,
+                        help='seconds a new state must hold. Defaults to %(default)s')
+    parser.add_argument('-s', '--stuck',
+                        action='store',
+                        type=float,
+                        default=STUCK,
+                        help='seconds before an unconfigured host counts as stuck. Defaults to %(default)s')
+    parser.add_argument('-L', '--limit',
+                        action='store',
+                        type=int,
+                        default=LIMIT,
+                        help='maximum action runs per window. Defaults to %(default)s')
+    parser.add_argument('-w', '--window',
+                        action='store',
+                        type=float,
+                        default=WINDOW,
+                        help='rate limit window in seconds. Defaults to %(default)s')
+    parser.add_argument('-d', '--debug',
+                        action='store_const',
+                        dest='debug',
+                        const=logging.DEBUG,
+                        default=LOG_LEVEL,
+                        help='Enable debug output')
+    parser.add_argument('-l', '--logfile',
+                        action='store',
+                        default=None,
+                        help='log file.')
+    args = parser.parse_args()
+
+    loggerconfig = {'format':'%(asctime)s %(levelname)s\t: %(message)s',
+                    'level':args.debug}
+    if args.logfile:
+        loggerconfig['filename'] = args.logfile
+    logging.basicConfig(**loggerconfig)
+    logging.debug('Command line args: %s' % args)
+
+    actions = {'attach': args.on_attach or [],
+               'detach': args.on_detach or [],
+               'suspend': args.on_suspend or [],
+               'stuck': args.on_stuck or ['rebind']}
+
+    if os.geteuid() != 0:
+        sys.exit('Must be root')
+
+    try:
+        while True:
+            udc = args.udc or findUDC(args.gadget)
+            if udc is None:
+                logging.debug('No UDC, waiting')
+                time.sleep(UDC_RETRY)
+                continue
+            try:
+                watch(udc, actions, args.gadget, args.interface,
+                      args.debounce, args.stuck, args.limit, args.window)
+            except OSError as e:
+                # UDC went away, e.g. its driver was unloaded
+                logging.warning('Lost %s (%s)' % (udc, e))
+                time.sleep(UDC_RETRY)
+    except KeyboardInterrupt:
+        pass
+    except:
+        logging.exception('Uncaught exception: ')
+        raise
+    finally:
+        logging.shutdown()